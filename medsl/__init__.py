@@ -1,35 +1,34 @@
 #!/usr/bin/env python3
 # coding: utf-8
 """
-Define module-level constants.
+Define module-level constants and shared helpers.
 """
 
-from collections import OrderedDict
-
 import numpy as np
 
 # These are used in filenames and correspond to what follows the underscores in Dataverse aliases (e.g., 'medsl_local')
 DATAVERSE_SHORT_NAMES = ['president', 'senate', 'house', 'state', 'local']
 
 # We expect these columns in release-ready precinct-level data for each state (e.g. 'AK/final/2016-ak-precinct.csv').
-# Guessing dtypes can fail when CSVS are large (and exceptions rare), so we specify types for each column.
-PRECINCT_COLS = OrderedDict({
+# Guessing dtypes can fail when CSVS are large (and exceptions rare), so we specify types for each column. Integer
+# types are the narrowest that hold all valid values, to keep the combined precinct data small in memory.
+PRECINCT_COLS = {
     # election characteristics
-    'year': int,
+    'year': np.int16,
     'stage': str,
     'special': bool,
     # state
     'state': str,
     'state_postal': str,
-    'state_fips': np.int_,
-    'state_icpsr': np.int_,
+    'state_fips': np.int8,
+    'state_icpsr': np.int16,
     # county
     'county_name': str,
-    # FIPS and ANSI codes should be integers but may be missing, which requires the float type
-    'county_fips': np.float_,
-    'county_ansi': np.float_,
-    'county_lat': np.float_,
-    'county_long': np.float_,
+    # FIPS and ANSI codes are integers but may be missing, so we use pandas' nullable integer type
+    'county_fips': 'Int32',
+    'county_ansi': 'Int32',
+    'county_lat': np.float64,
+    'county_long': np.float64,
     # administrative jurisdictions
     'jurisdiction': str,
     'precinct': str,
@@ -45,7 +44,7 @@ PRECINCT_COLS = OrderedDict({
     'candidate_fec_name': str,
     'candidate_google': str,
     'candidate_govtrack': str,
-    'candidate_icpsr': np.float_,
+    'candidate_icpsr': 'Int32',
     'candidate_maplight': str,
     'candidate_normalized': str,
     'candidate_opensecrets': str,
@@ -57,10 +56,17 @@ PRECINCT_COLS = OrderedDict({
     'writein': bool,
     'party': str,
     'mode': str,
-    'votes': np.int_,
+    'votes': np.int32,
     # data management: expected in final CSVs, excluded from release
     'dataverse': str,
-})
+}
 
 # TODO: read from yaml
 US_SENATE_RACES = ['AK', 'AR', 'CO', 'FL', 'GA', 'IL', 'IN', 'IA', 'KY', 'LA', 'MO', 'NV', 'NH', 'NC', 'OH', 'PA', 'WI']
+
+
+def apply_substitutions(text: str, substitutions: list) -> str:
+    """Apply (compiled pattern, replacement) substitutions to a string, in order."""
+    for pattern, replacement in substitutions:
+        text = pattern.sub(replacement, text)
+    return text
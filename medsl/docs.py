@@ -8,36 +8,38 @@ metadata (see './metadata').
 
 Can be run as a script, but also used by release.py.
 """
+import functools
 import logging
 import re
 from pathlib import Path
 
 import pandas as pd
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
 
 from medsl import DATAVERSE_SHORT_NAMES
 from medsl.metadata import Metadata
 from medsl.paths import dataset_output_path, module_path, r_output_dir, precinct_returns_dir
 
+# Patterns used by the Jinja filters below, compiled once rather than looked up on every filter call
+dash_pattern = re.compile('[- ]')
+alias_pattern = re.compile(r'([0-9]*)(_*)(.*)')
+code_pattern = re.compile(r'`([^`]+)`')
+
 
 class Documentation(object):
     """A class for dataset documentation.
     """
 
     def __init__(self):
-        template_loader = FileSystemLoader(searchpath=str(module_path / 'templates'))
-        self.env = Environment(loader=template_loader)
-        # The Rd template avoids using braces as delimiters
-        self.rd_env = Environment(loader=template_loader, block_start_string='<+', block_end_string='+>',
-                                  variable_start_string='<<', variable_end_string='>>', comment_start_string='<#',
-                                  comment_end_string='>#')
-        # Add custom filters
-        self.rd_env.filters['r_alias'] = r_alias
-        self.rd_env.filters['format_code'] = format_code
-        self.codebook_template = self.env.get_template('codebook.jinja')
-        self.notes_template = self.env.get_template('release_notes.jinja')
-        self.coverage_template = self.env.get_template('coverage_notes.jinja')
-        self.rdata_template = self.rd_env.get_template('r_doc.jinja')
+        # Environments and templates are built once per process, on first use; see load_templates()
+        templates = load_templates()
+        self.env = templates['env']
+        self.rd_env = templates['rd_env']
+        self.codebook_template = templates['codebook']
+        self.notes_template = templates['notes']
+        self.coverage_template = templates['coverage']
+        self.rdata_template = templates['rdata']
+        self.readme_template = templates['readme']
 
     def write(self, dataverse: str) -> None:
         """Write documentation to disk.
@@ -49,15 +51,13 @@ class Documentation(object):
         # Load metadata
         metadata = Metadata(dataverse)
 
-        # Populate templates
-        codebook = self.codebook_template.render(dataset=metadata.dataset_meta,
-                                                 dataverse=metadata.dataverse_meta,
-                                                 variables=metadata.variable_meta)
-        coverage = self.coverage_template.render(dataset=metadata.dataset_meta, states=metadata.coverage)
-        notes = self.notes_template.render(dataset=metadata.dataset_meta)
-        rdata_rd = self.rdata_template.render(dataset=metadata.dataset_meta,
-                                              dataverse=metadata.dataverse_meta,
-                                              variables=metadata.variable_meta)
+        # Context shared by all the templates; each uses a subset of these keys
+        context = {
+            'dataset': metadata.dataset_meta,
+            'dataverse': metadata.dataverse_meta,
+            'variables': metadata.variable_meta,
+            'states': metadata.coverage,
+        }
 
         # Destination directory is the name of the dataset YAML, less the .yaml extension,
         # e.g. '2016-precinct-president', under the path returned by dataset_output_path().
@@ -65,35 +65,47 @@ class Documentation(object):
 
         # Write documentation to disk
         dataset_name = Path(metadata.dataset_yaml).stem
-        (output_dir / 'codebook-{}.md'.format(dataset_name)).write_text(codebook)
-        (output_dir / 'release-notes-{}.md'.format(dataset_name)).write_text(notes)
-        (output_dir / 'coverage-notes-{}.md'.format(dataset_name)).write_text(coverage)
-        (r_output_dir / '{}.Rd'.format(metadata.dataset_meta['r_alias'])).write_text(rdata_rd)
+        write_template(self.codebook_template, context, output_dir / 'codebook-{}.md'.format(dataset_name))
+        write_template(self.notes_template, context, output_dir / 'release-notes-{}.md'.format(dataset_name))
+        write_template(self.coverage_template, context, output_dir / 'coverage-notes-{}.md'.format(dataset_name))
+        write_template(self.rdata_template, context, r_output_dir / '{}.Rd'.format(metadata.dataset_meta['r_alias']))
         logging.info('Wrote docs to {} and {}'.format(output_dir, r_output_dir))
 
     def write_readme(self):
         """Generate the readme for the precinct-returns repo."""
-        readme_template = self.env.get_template('precinct_readme.jinja')
         # Read metadata for the codebook. It doesn't matter which dataset we specify here; variables are the
         # same across the precinct datasets.
         metadata = Metadata('house')
         # Read the coverage notes for precinct datasets
-        readme = readme_template.render(variables=metadata.variable_meta, states=metadata.coverage)
-        (precinct_returns_dir / 'README.md').write_text(readme)
+        write_template(self.readme_template, {'variables': metadata.variable_meta, 'states': metadata.coverage},
+                       precinct_returns_dir / 'README.md')
         logging.info('Wrote precinct-returns readme to {}'.format(precinct_returns_dir))
 
 
+def write_template(template: Template, context: dict, path: Path, buffer_size: int = 1 << 20) -> None:
+    """Render a template directly to a file, through a single large buffer and with Unix newlines.
+
+    Streaming the output avoids holding the whole rendered document in memory.
+    """
+    with open(path, 'w', buffering=buffer_size, encoding='utf-8', newline='\n') as f:
+        template.stream(context).dump(f)
+
+
 def write_frequencies(df: pd.DataFrame, destination: str = '') -> pd.DataFrame:
     """Create a variable-value frequency table, optionally writing it to disk.
     """
-    counts = {}
-    for col in [var for var in df.columns.values if var != 'votes']:
-        counts[col] = df[col].value_counts(dropna=False)
+    # Count values per column (a hashtable pass each), then stack the counts into one long table with a single
+    # concat. Melting the whole frame and grouping once would allocate rows x columns values.
     count_dfs = []
-    for k, v in counts.items():
-        count_dfs.append(pd.DataFrame({'variable': k, 'count': v}).reset_index().rename({'index': 'value'}, axis=1))
-    df = pd.concat(count_dfs)
-    df = df[['variable', 'value', 'count']]
+    for col in [var for var in df.columns if var != 'votes']:
+        counts = df[col].value_counts(dropna=False)
+        # Categorical columns count unobserved categories as zero; keep only observed values
+        counts = counts[counts > 0]
+        # Each column gets its own object-typed values, so values from different columns (e.g., 1 and True) can't
+        # be merged or recast by a shared index
+        count_dfs.append(pd.DataFrame({'variable': col, 'value': counts.index.astype(object),
+                                       'count': counts.to_numpy()}))
+    df = pd.concat(count_dfs, ignore_index=True)
     df = df.sort_values(['variable', 'value', 'count'])
     df.reset_index(drop=True, inplace=True)
     if destination:
@@ -101,6 +113,8 @@ def write_frequencies(df: pd.DataFrame, destination: str = '') -> pd.DataFrame:
     return df
 
 
+# Jinja calls the filters below with the same few strings repeatedly, so we memoize them
+@functools.lru_cache(maxsize=128)
 def r_alias(text: str) -> str:
     """Translate dataset names to valid R object names.
 
@@ -108,24 +122,52 @@ def r_alias(text: str) -> str:
     This is a Jinja filter. See http://jinja.pocoo.org/docs/2.10/api/#custom-filters.
     """
     if text:
-        print(text)
-        no_dashes = re.sub('[- ]', '_', text)
-        return re.sub(r'([0-9]*)(_*)(.*)', '\g<3>\g<2>\g<1>', no_dashes)
+        no_dashes = dash_pattern.sub('_', text)
+        return alias_pattern.sub(r'\g<3>\g<2>\g<1>', no_dashes)
     else:
         return ''
 
 
+@functools.lru_cache(maxsize=128)
 def format_code(text: str) -> str:
     """Translate `Markdown code` syntax to \code{Latex code} syntax.
 
     This is a Jinja filter. See http://jinja.pocoo.org/docs/2.10/api/#custom-filters.
     """
     if text:
-        return re.sub(r'`([^`]+)`', '\code{\g<1>}', text)
+        return code_pattern.sub(r'\\code{\g<1>}', text)
     else:
         return ''
 
 
+@functools.lru_cache(maxsize=None)
+def load_templates() -> dict:
+    """Build the Jinja environments and compile the templates, once per process and only when first needed.
+
+    Building them on first use rather than at import keeps `import medsl.docs` (e.g., by validate.py, for
+    write_frequencies) cheap. The bytecode cache (in the system temp directory) lets later runs skip parsing the
+    template source.
+    """
+    template_loader = FileSystemLoader(searchpath=str(module_path / 'templates'))
+    bytecode_cache = FileSystemBytecodeCache()
+    env = Environment(loader=template_loader, bytecode_cache=bytecode_cache)
+    # The Rd template avoids using braces as delimiters
+    rd_env = Environment(loader=template_loader, bytecode_cache=bytecode_cache, block_start_string='<+',
+                         block_end_string='+>', variable_start_string='<<', variable_end_string='>>',
+                         comment_start_string='<#', comment_end_string='>#')
+    # Add custom filters
+    rd_env.filters['r_alias'] = r_alias
+    rd_env.filters['format_code'] = format_code
+    return {
+        'env': env,
+        'rd_env': rd_env,
+        'codebook': env.get_template('codebook.jinja'),
+        'notes': env.get_template('release_notes.jinja'),
+        'coverage': env.get_template('coverage_notes.jinja'),
+        'readme': env.get_template('precinct_readme.jinja'),
+        'rdata': rd_env.get_template('r_doc.jinja'),
+    }
+
 if __name__ == '__main__':
     docs = Documentation()
     for dataverse in DATAVERSE_SHORT_NAMES:
@@ -3,13 +3,42 @@
 Read YAML-formatted metadata files from ./metadata.
 """
 
+import copy
 import datetime
+import functools
 import logging
+from pathlib import Path
 
 import yaml
 
+try:
+    # Prefer the libyaml-backed parser, which is much faster than the pure-Python one
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
 from medsl.paths import dataset_meta_yaml_path, module_path
 
+# Datasets are versioned by release date. Read the date once, so all datasets in a run share a version.
+TODAY = str(datetime.date.today())
+
+
+@functools.lru_cache(maxsize=None)
+def read_yaml(path: str):
+    """Read a YAML file, parsing each file only once per run.
+
+    The result is shared between callers, so copy it before mutating.
+    """
+    return yaml.load(Path(path).read_text(), Loader=YAMLLoader)
+
+
+def read_coverage() -> dict:
+    """Read the precinct data coverage notes for each state.
+
+    The result is cached and shared between callers, so don't mutate it.
+    """
+    return read_yaml(str(dataset_meta_yaml_path('common/precinct-coverage.yaml')))
+
 
 class Metadata(object):
     """Metadata for precinct returns.
@@ -20,25 +49,27 @@ class Metadata(object):
         self.dataset_yaml = dataset_meta_yaml_path('2016-precinct-{}.yaml'.format(dataverse))
         self.dataset_meta = self._read_dataset_yaml()
         self.variable_meta = self._read_variable_yaml()
+        self.documented_cols = frozenset(var['name'] for var in self.variable_meta)
         self.dataverse_meta = self._read_dataverse_yaml()
         self.coverage = self._read_coverage()
         # Use today's date as version
-        self.dataset_meta['version'] = str(datetime.datetime.today().date())
+        self.dataset_meta['version'] = TODAY
 
     def _read_dataset_yaml(self):
         """Read metadata from the YAML file for a dataset, and any metadata inherited from other files.
         """
-        dataset_meta = yaml.load(self.dataset_yaml.read_text())
+        # Copy the cached dict, because we add inherited metadata and a version below
+        dataset_meta = copy.deepcopy(read_yaml(str(self.dataset_yaml)))
         if 'inherits' in dataset_meta:
             # The dataset inherits metadata from another file; read each of these
             for inherited in dataset_meta['inherits']:
                 # Descend into 'common' from the location of the dataset YAML and read the indicated file
-                inherited_meta = yaml.load((self.dataset_yaml.parent / 'common' / inherited).read_text())
+                inherited_meta = read_yaml(str(self.dataset_yaml.parent / 'common' / inherited))
                 # Add the inherited metadata
                 for k, v in inherited_meta.items():
                     # But dataset metadata takes precedence; ignore existing keys
                     if k not in dataset_meta:
-                        dataset_meta[k] = v
+                        dataset_meta[k] = copy.deepcopy(v)
         return dataset_meta
 
     def _read_variable_yaml(self):
@@ -47,24 +78,25 @@ class Metadata(object):
         We require from dataset_meta the keys 'variables' and 'variable_notes', if any.
         """
         # Load variable definitions. These are common to all election-returns datasets.
-        variable_meta = yaml.load((module_path / 'metadata' / 'variables.yaml').read_text())
+        variable_meta = read_yaml(str(module_path / 'metadata' / 'variables.yaml'))
         # The 'variables' key of the dataset metadata is a list of the variables that appear in the dataset.
-        # Filter definitions to those actually in the dataset.
-        variable_meta = [var for var in variable_meta if var['name'] in self.dataset_meta['variables']]
+        # Filter definitions to those actually in the dataset, copying each because notes are dataset-specific.
+        dataset_variables = set(self.dataset_meta['variables'])
+        variable_meta = [dict(var) for var in variable_meta if var['name'] in dataset_variables]
         if 'variable_notes' in self.dataset_meta:
             logging.debug('Updating variable notes from dataset metadata:')
+            notes = {note['name']: note['note'] for note in self.dataset_meta['variable_notes']}
             for var in variable_meta:
-                for note in self.dataset_meta['variable_notes']:
-                    if var['name'] == note['name']:
-                        var['note'] = note['note']
-                        logging.debug('  {}'.format(var['name']))
+                if var['name'] in notes:
+                    var['note'] = notes[var['name']]
+                    logging.debug('  {}'.format(var['name']))
         return variable_meta
 
     def _read_dataverse_yaml(self):
         """Read dataverse metadata from YAML given the dataverse alias (e.g. 'medsl_senate')
         """
         path = self.dataset_yaml.parent.parent / 'dataverse' / 'medsl_{}.yaml'.format(self.dataverse)
-        return yaml.load(path.read_text())
+        return read_yaml(str(path))
 
     def _read_coverage(self):
-        return yaml.load(dataset_meta_yaml_path('common/precinct-coverage.yaml').read_text())
+        return read_coverage()
@@ -3,8 +3,13 @@
 Provide Open Elections returns for validation. WIP; not yet in use.
 """
 
+import re
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+import pyarrow.csv
 
+from medsl import apply_substitutions
 from medsl.paths import openelections_dir
 
 
@@ -12,22 +17,41 @@ def read_oe_precincts(path, usecols=['county', 'precinct', 'office', 'district',
     """Read expected columns from an Open Elections returns CSV."""
     # path = openelections_path() / 'openelections-data-ny/2016/20161108__ny__general__allegany__precinct.csv'
     try:
-        df = pd.read_csv(path, usecols=usecols, low_memory=False)
-    except ValueError as e:
+        # Arrow's CSV reader parses blocks of each file on multiple threads
+        table = pyarrow.csv.read_csv(
+            str(path),
+            read_options=pyarrow.csv.ReadOptions(use_threads=True),
+            # Like pandas, allow newlines in quoted values
+            parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+            # Like pandas, treat empty strings as missing
+            convert_options=pyarrow.csv.ConvertOptions(include_columns=list(usecols), strings_can_be_null=True),
+        )
+        df = table.to_pandas()
+    except KeyError as e:
+        # pyarrow raises ArrowKeyError for missing columns
         print("Error reading {}: {}".format(path, e))
-        df = pd.read_csv(path, low_memory=False, thousands=',', dtype={'votes': 'float'})
+        # Only the header is needed to report which columns are missing
+        df = pd.read_csv(path, nrows=0)
         missing_cols = set(usecols) - set(df.columns)
         print('Missing columns {}'.format(', '.join(sorted(missing_cols))))
         print('Found columns {}'.format(', '.join(sorted(df.columns))))
         return None
+    except ValueError as e:
+        # pyarrow raises ArrowInvalid for files it can't parse; pandas' parser is more lenient, so fall back to it
+        print("Error reading {} with pyarrow, reading with pandas: {}".format(path, e))
+        df = pd.read_csv(path, usecols=usecols, low_memory=False)
     df['path'] = path.name
     return df
 
 
 def read_oe_dir(path):
     """Read precinct returns from a directory of Open Elections returns CSVs."""
-    csv_paths = path.glob('*precinct.csv')
-    df = pd.concat([read_oe_precincts(p) for p in csv_paths])
+    csv_paths = list(path.glob('*precinct.csv'))
+    # Arrow's CSV reader releases the GIL, so threads overlap both reading and parsing
+    with ThreadPoolExecutor(max_workers=min(16, max(len(csv_paths), 1))) as executor:
+        # Results come back in path order; files that failed to read are None and skipped
+        frames = (df for df in executor.map(read_oe_precincts, csv_paths) if df is not None)
+        df = pd.concat(frames, ignore_index=True, sort=False)
     df = coerce_vote_type(df)
     df = normalize_candidates(df)
     df = drop_totals(df)
@@ -35,27 +59,44 @@ def read_oe_dir(path):
 
 
 def coerce_vote_type(df):
-    df.votes[df.votes.apply(type) == str] = df.votes[df.votes.apply(type) == str].str.replace(',', '')
-    df.votes = df.votes.astype('float')
+    votes = df['votes']
+    if votes.dtype == object:
+        # Strip thousands separators in one pass; regex replacement skips non-string values (e.g., NaN)
+        votes = votes.replace(',', '', regex=True)
+    df['votes'] = votes.astype('float')
     return df
 
 
+# Substitutions for normalizing candidate names, applied in order to lowercased names
+CANDIDATE_SUBSTITUTIONS = [
+    (re.compile(r'\(.*\)'), ''),
+    (re.compile(r' [a-z]\.* '), ' '),
+    (re.compile(r'([^,]+), ([^,]+)'), r'\2 \1'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\.$'), ''),
+    # Replaces only the exact value ', i'
+    (re.compile(r'\A, i\Z'), ' i'),
+    (re.compile(r'.*write.*in.*'), 'write-in'),
+    (re.compile(r'\s*/\s*'), '/'),
+]
+
+
+def normalize_candidate(name: str) -> str:
+    """Normalize a lowercased candidate name."""
+    return apply_substitutions(name, CANDIDATE_SUBSTITUTIONS).strip()
+
+
 def normalize_candidates(df):
-    df.candidate = df.candidate.str.lower() \
-        .replace(r'\(.*\)', '', regex=True) \
-        .replace(r' [a-z]\.* ', ' ', regex=True) \
-        .replace(r'([^,]+), ([^,]+)', r'\2 \1', regex=True) \
-        .replace(r'\s+', ' ', regex=True) \
-        .replace(r'\.$', '', regex=True) \
-        .replace(', i', ' i') \
-        .replace(r'.*write.*in.*', 'write-in', regex=True) \
-        .replace('\s*/\s*', '/', regex=True) \
-        .str.strip()
+    candidates = df.candidate.str.lower()
+    # Names repeat across precincts, so normalize each distinct name once and map the results back
+    normalized = {name: normalize_candidate(name) for name in candidates.dropna().unique()}
+    df.candidate = candidates.map(normalized)
     return df
 
 
 def drop_totals(df):
-    return df.loc[~df.candidate.str.contains('total', case=False, na=False)]
+    # A plain substring test; 'total' has no regex metacharacters
+    return df.loc[~df.candidate.str.contains('total', case=False, regex=False, na=False)]
 
 
 def tally_by_candidate_office(df):
@@ -2,10 +2,13 @@
 """
 Resolve paths to data.
 
-These functions encode file naming conventions.
+These functions encode file naming conventions. The base directories are resolved once at import, so the functions
+below only join path components and don't touch the filesystem.
 """
 
+import functools
 from pathlib import Path
+from typing import Iterator
 
 import medsl
 
@@ -20,39 +23,35 @@ precinct_returns_source_dir = precinct_returns_dir / 'source'
 
 openelections_dir = (module_path.parent.parent / 'openelections').resolve()
 
+dataset_meta_dir = module_path / 'metadata' / 'dataset'
+
 
 def dataset_output_path(dataset_yaml_path: Path) -> Path:
     """Get the path to the output directory for release-ready files."""
-    p = module_path.parent.parent / 'precinct-returns' / dataset_yaml_path.stem
-    return p.resolve()
+    return precinct_returns_dir / dataset_yaml_path.stem
 
 
 def dataset_csv_path(dataset_yaml_path: Path) -> Path:
     """Get the path for a release-ready CSV."""
-    output_path = dataset_output_path(dataset_yaml_path)
-    p = output_path / '{}.csv'.format(dataset_yaml_path.stem)
-    return p.resolve()
+    return dataset_output_path(dataset_yaml_path) / '{}.csv'.format(dataset_yaml_path.stem)
 
 
+@functools.lru_cache(maxsize=64)
 def state_csv_path(state_abbr: str) -> Path:
     """Get the path for a final state CSV."""
-    p = precinct_data_dir / state_abbr.upper() / 'final' / '2016-{}-precinct.csv'.format(state_abbr.lower())
-    return p.resolve()
+    return precinct_data_dir / state_abbr.upper() / 'final' / '2016-{}-precinct.csv'.format(state_abbr.lower())
 
 
 def dataset_rda_path(r_alias: str) -> Path:
     """Get the path for a release-ready rda."""
-    p = r_output_dir / '{}.rda'.format(r_alias)
-    return p.resolve()
+    return r_output_dir / '{}.rda'.format(r_alias)
 
 
-def precinct_yaml_paths():
-    """Get an iterable of paths to the YAML metadata for 2016 precinct datasets."""
-    p = module_path / 'metadata' / 'dataset'
-    return p.resolve().glob('2016-precinct*.yaml')
+def precinct_yaml_paths() -> Iterator[Path]:
+    """Get an iterator over paths to the YAML metadata for 2016 precinct datasets."""
+    return dataset_meta_dir.glob('2016-precinct*.yaml')
 
 
 def dataset_meta_yaml_path(dataset_name: str) -> Path:
     """Get the path to a dataset's YAML metadata file."""
-    p = module_path / 'metadata' / 'dataset' / dataset_name
-    return p.resolve()
+    return dataset_meta_dir / dataset_name
@@ -2,40 +2,71 @@
 """
 Create R package datasets (rda files).
 
-The approach is to write the DataFrame to disk as feather, and then read that file into R and write it back as rda.
-
-This relies on system calls to R, which is fragile, but rpy2 choked on the DataFrames.
+The approach is to stream an Arrow table to an Rscript process (table_to_rda_async), which reads it and writes it
+back as rda. R reads the data itself, rather than receiving it through rpy2, because rpy2 choked on the DataFrames.
 """
+import logging
 import subprocess
 from pathlib import Path
 
+import pyarrow
+import pyarrow.ipc
 from rpy2 import robjects
 from rpy2.robjects import pandas2ri
 
 from medsl.paths import dataset_rda_path, module_path
 
-pandas2ri.activate()
+# Whether pandas2ri conversion has been activated, which pandas_to_rda() does on first use
+_pandas2ri_active = False
+
 
+def table_to_rda_async(table: pyarrow.Table,
+                       output_path: Path,
+                       r_alias: str,
+                       script_name: str = 'feather_to_rda.R') -> subprocess.Popen:
+    """Send an Arrow table to an R script that writes it to an Rda, without waiting for R to finish.
 
-def file_to_rda(input_path: Path,
-                output_path: Path,
-                r_alias: str,
-                script_name: str = 'feather_to_rda.R') -> subprocess.CompletedProcess:
-    """Make a system call to an R script that reads a data file and writes it to an Rda.
+    The table is streamed to the script's stdin in the Arrow IPC format, so no intermediate file is written and read
+    back. This returns once R has read the table; callers should wait() on the returned process.
     """
-    r_call = [
+    process = subprocess.Popen(rscript_call('-', output_path, r_alias, script_name), stdin=subprocess.PIPE)
+    # If R exits early (e.g., a missing package), writing or closing the pipe raises BrokenPipeError (an OSError).
+    # Keep the first error, and don't let it stop the caller from writing other release files.
+    error = None
+    try:
+        with pyarrow.ipc.new_stream(process.stdin, table.schema) as writer:
+            writer.write_table(table)
+    except OSError as e:
+        error = e
+    try:
+        process.stdin.close()
+    except OSError as e:
+        error = error or e
+    if error:
+        logging.error('Error sending data to R for {}: {}; R exited with status {}'.format(output_path, error,
+                                                                                          process.wait()))
+    return process
+
+
+def rscript_call(input_path: str, output_path: Path, r_alias: str, script_name: str) -> list:
+    """Build the command line for an R script that reads a data file (or '-' for stdin) and writes it to an Rda."""
+    return [
         str(Path('/usr/bin/Rscript').resolve()),
         str(module_path / script_name),
-        str(input_path.resolve()),
+        input_path,
         r_alias,
         str(output_path),
     ]
-    return subprocess.run(r_call)
 
 
 def pandas_to_rda(df, path):
     """Write a Pandas DataFrame to an rda.
     """
+    global _pandas2ri_active
+    # Activating conversion registers converters for every rpy2 call, so only do it once it's needed
+    if not _pandas2ri_active:
+        pandas2ri.activate()
+        _pandas2ri_active = True
     r_dataframe = pandas2ri.py2ri(df)
     robjects.globalenv['df'] = r_dataframe
     robjects.r['save']('df', file=path)
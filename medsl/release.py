@@ -3,22 +3,59 @@
 """
 Prepare for release the precinct-level data in the '2016-precinct-data' directory.
 """
+import io
 import logging
+import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO
 from zipfile import ZipFile, ZIP_DEFLATED
 
-import feather
+import numpy as np
 import pandas as pd
 import pyarrow
-import yaml
+import pyarrow.csv
 
 from medsl import PRECINCT_COLS, DATAVERSE_SHORT_NAMES
 from medsl.docs import Documentation, write_frequencies
-from medsl.metadata import Metadata
-from medsl.paths import dataset_csv_path, state_csv_path, dataset_meta_yaml_path, precinct_returns_source_dir, \
-    module_path, dataset_output_path
-from medsl.rdas import file_to_rda
+from medsl.metadata import Metadata, read_coverage
+from medsl.paths import dataset_csv_path, state_csv_path, precinct_returns_source_dir, module_path, \
+    dataset_output_path
+from medsl.rdas import table_to_rda_async
+
+# Arrow equivalents of the pandas/NumPy dtypes in PRECINCT_COLS, for reading state CSVs with pyarrow
+ARROW_TYPES = {
+    str: pyarrow.string(),
+    bool: pyarrow.bool_(),
+    np.int8: pyarrow.int8(),
+    np.int16: pyarrow.int16(),
+    np.int32: pyarrow.int32(),
+    # Nullable integer columns can hold float-formatted values like '1001.0', which Arrow won't parse as ints. Read
+    # them as floats, as pandas did, and cast them to Int32 after conversion.
+    'Int32': pyarrow.float64(),
+    np.float64: pyarrow.float64(),
+}
+# Low-cardinality columns we hold as categoricals, which are smaller in memory and sort by integer codes
+CATEGORICAL_COLS = ['dataverse', 'state', 'party', 'office']
+# Deflate level for zip archives. On CSVs, level 1 is several times faster than the default (6), and the archives are
+# only slightly larger.
+ZIP_COMPRESSLEVEL = 1
+# Rows converted and written to a dataset CSV at a time
+CSV_CHUNK_ROWS = 100000
+# Read (only) the PRECINCT_COLS columns, in that order, and like pandas read empty strings as missing
+PRECINCT_CSV_OPTIONS = pyarrow.csv.ConvertOptions(
+    column_types={col: ARROW_TYPES[dtype] for col, dtype in PRECINCT_COLS.items()},
+    include_columns=list(PRECINCT_COLS),
+    strings_can_be_null=True,
+)
+# Like pandas, allow quoted values (e.g., precinct names) to contain newlines
+PRECINCT_CSV_PARSE_OPTIONS = pyarrow.csv.ParseOptions(newlines_in_values=True)
+
+# Lookups between state postal abbreviations and names, e.g. 'AL' <-> 'Alabama'
+_state_ids = pd.read_csv(module_path / 'gazetteers' / 'states.csv')
+STATE_NAMES = dict(zip(_state_ids.state_postal, _state_ids.state))
+STATE_POSTALS = {name: postal for postal, name in STATE_NAMES.items()}
 
 
 class PrecinctData(object):
@@ -39,55 +76,79 @@ class PrecinctData(object):
         :param state_postals: Postal abbreviations for states to include. By default, states with included=True in
         `precinct-coverage.yaml` will be included.
         """
-        self.coverage = yaml.load(dataset_meta_yaml_path('common/precinct-coverage.yaml').read_text())
-        state_ids = pd.read_csv(module_path / 'gazetteers' / 'states.csv')
+        self.coverage = read_coverage()
         if state_postals:
             # Include specified states, regardless of how precinct data coverage is defined
             self.state_postals = state_postals
             # Walk from state postal abbreviations to state names
-            self.state_names = list(state_ids.loc[state_ids.state_postal.isin(state_ids), 'state'].values)
+            self.state_names = [STATE_NAMES[postal] for postal in state_postals if postal in STATE_NAMES]
         else:
             # Include states with included=True in `precinct-coverage.yaml`
             self.state_names = [k for k, v in self.coverage.items() if v['included']]
             # Walk from state names to state postal abbreviations for use in paths
-            self.state_postals = list(state_ids.loc[state_ids.state.isin(self.state_names), 'state_postal'].values)
+            self.state_postals = [STATE_POSTALS[name] for name in self.state_names if name in STATE_POSTALS]
         self.precinct_returns = self.read_precincts()
+        # Row positions by `dataverse` value, found in one pass and reused to subset each dataset
+        self.dataverse_rows = self.precinct_returns.groupby('dataverse', sort=False, observed=True).indices
 
     def copy_state_csvs(self):
         """Copy the state CSVs to a `sources` subdirectory of the output directory.
         """
-        for state_postal in self.state_postals:
-            self.copy_precinct_csv(state_postal)
+        # States are independent; zlib and the file copy release the GIL, so threads overlap the work
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # Consume the results to surface any exceptions
+            list(executor.map(self.copy_precinct_csv, self.state_postals))
 
     def read_precincts(self) -> pd.DataFrame:
         """Read precinct-level returns for all states indicated in the state_postals attribute.
         """
-        precinct_returns = pd.concat([self.read_precinct_csv(state) for state in self.state_postals])
-        # Select and reorder columns; sort rows
-        precinct_returns = precinct_returns[list(PRECINCT_COLS)]
+        # Read states concurrently; Arrow's CSV parser releases the GIL and is itself multithreaded
+        with ThreadPoolExecutor(max_workers=min(32, max(len(self.state_postals), 1))) as executor:
+            tables = [table for table in executor.map(self.read_precinct_csv, self.state_postals) if table is not None]
+        # Tables hold just the PRECINCT_COLS columns, in order and with the same types, so concatenation is cheap
+        table = pyarrow.concat_tables(tables)
+        # Arrow converts bool columns with nulls to object, and casting those to bool would read nulls as False. Raise
+        # instead, as pandas does when reading these columns.
+        for col, dtype in PRECINCT_COLS.items():
+            if dtype is bool and table.column(col).null_count:
+                raise ValueError('Bool column has NA values in column {}'.format(col))
+        precinct_returns = table.to_pandas()
+        # Arrow converts integer columns with nulls to float; cast to the expected dtypes, as pandas would read them
+        non_str_cols = {col: dtype for col, dtype in PRECINCT_COLS.items() if dtype is not str}
+        precinct_returns = precinct_returns.astype(non_str_cols)
+        precinct_returns = precinct_returns.astype({col: 'category' for col in CATEGORICAL_COLS})
+        # Sort rows. sort_values sorts categorical columns by their integer codes.
         sort_order = ['dataverse', 'state', 'jurisdiction', 'precinct', 'candidate', 'party']
-        precinct_returns = precinct_returns.sort_values(sort_order)
+        precinct_returns = precinct_returns.sort_values(sort_order, kind='stable')
         return precinct_returns
 
     @staticmethod
-    def read_precinct_csv(state_abbr: str) -> pd.DataFrame:
-        """Given a state postal abbreviation, read the corresponding precinct-level returns."""
+    def read_precinct_csv(state_abbr: str) -> pyarrow.Table:
+        """Given a state postal abbreviation, read the corresponding precinct-level returns.
+
+        Returns None if there is no file for the state.
+        """
         csv_path = state_csv_path(state_abbr)
         logging.debug('Reading {}'.format(csv_path))
         try:
-            df = pd.read_csv(csv_path, dtype=PRECINCT_COLS, low_memory=False, index_col=False)
-        except UnicodeDecodeError:
-            logging.error('UnicodeDecodeError reading {}'.format(csv_path))
-            df = pd.read_csv(csv_path, dtype=PRECINCT_COLS, low_memory=False, encoding='latin1', index_col=False)
+            table = pyarrow.csv.read_csv(str(csv_path), parse_options=PRECINCT_CSV_PARSE_OPTIONS,
+                                         convert_options=PRECINCT_CSV_OPTIONS)
         except FileNotFoundError as e:
             logging.error('No file for {}: {}'.format(state_abbr, e))
-            df = pd.DataFrame()
-        except ValueError as e:
-            # Re-read without dtypes to get column names for debugging
-            headers = pd.read_csv(csv_path, nrows=0)
-            logging.error('Reading {} with columns {}'.format(state_abbr, headers.columns.values))
-            raise e
-        return df
+            table = None
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowKeyError) as e:
+            # ArrowKeyError indicates missing columns
+            if 'invalid UTF8' in str(e):
+                logging.error('UnicodeDecodeError reading {}'.format(csv_path))
+                table = pyarrow.csv.read_csv(str(csv_path), read_options=pyarrow.csv.ReadOptions(encoding='latin1'),
+                                             parse_options=PRECINCT_CSV_PARSE_OPTIONS,
+                                             convert_options=PRECINCT_CSV_OPTIONS)
+            else:
+                # Re-read without dtypes to get column names for debugging
+                headers = pd.read_csv(csv_path, nrows=0)
+                logging.error('Reading {} with columns {}'.format(state_abbr, headers.columns.values))
+                raise e
+        return table
 
     @staticmethod
     def copy_precinct_csv(state_abbr: str, zip=True) -> None:
@@ -95,9 +156,10 @@ class PrecinctData(object):
         """
         state_csv = state_csv_path(state_abbr)
         dataset_csv = precinct_returns_source_dir / state_csv.name
-        shutil.copy2(state_csv, dataset_csv)
+        # Copy contents only; copyfile uses the OS's fast in-kernel copy where available (e.g., sendfile on Linux)
+        shutil.copyfile(state_csv, dataset_csv)
         if zip:
-            with ZipFile(dataset_csv.with_suffix('.zip'), 'w', ZIP_DEFLATED) as zip:
+            with ZipFile(dataset_csv.with_suffix('.zip'), 'w', ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zip:
                 zip.write(dataset_csv, dataset_csv.name)
 
 
@@ -116,20 +178,25 @@ class Dataset(object):
         """
         self.dataverse = dataverse
         # Subset from all the precinct data to rows assigned to the dataverse, or included in all dataverses
-        subset = precinct_data.precinct_returns.loc[
-            precinct_data.precinct_returns['dataverse'].isin([self.dataverse, 'all'])]
-        # Don't include the dataverse column, used only for this subsetting, in the release data
-        del subset['dataverse']
-        self.table = subset
+        precinct_returns = precinct_data.precinct_returns
+        rows = [precinct_data.dataverse_rows[k] for k in [self.dataverse, 'all'] if k in precinct_data.dataverse_rows]
+        # Sort positions to keep the row order of precinct_returns
+        rows = np.sort(np.concatenate(rows)) if rows else np.array([], dtype=np.intp)
+        # Don't include the dataverse column, used only for this subsetting, in the release data. Selecting rows and
+        # columns together copies the data once.
+        columns = precinct_returns.columns.get_indexer(precinct_returns.columns.drop('dataverse'))
+        self.table = precinct_returns.iloc[rows, columns]
         # Resolve output paths
         self.yaml_file = Path('2016-precinct-{}.yaml'.format(self.dataverse))
         self.output_path = dataset_output_path(self.yaml_file)
         self.csv_path = dataset_csv_path(self.yaml_file)
-        self.feather_path = self.csv_path.with_suffix('.feather')
+        self.zip_path = self.csv_path.with_suffix('.zip')
         self.rda_path = self.csv_path.with_suffix('.rda')
         self.frequencies_path = self.output_path / 'frequencies-{}.csv'.format(self.csv_path.stem)
         # Read associated metadata
         self.metadata = Metadata(dataverse)
+        # The R process writing the rda, started by release()
+        self.rda_process = None
 
     def release(self) -> None:
         """Write a dataset and its documentation to disk.
@@ -137,42 +204,55 @@ class Dataset(object):
         # Write release files to output directory
         if not self.csv_path.parent.exists():
             self.csv_path.parent.mkdir()
-        self.table.to_csv(self.csv_path, index=False)
-        self.write_feather(self.table)
+        try:
+            arrow_table = pyarrow.Table.from_pandas(self.table, preserve_index=False)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            logging.error('Error converting {} subset to Arrow:'.format(self.dataverse))
+            # We see these errors when attempting to convert 'object' dtypes that can't be mapped to Arrow types
+            self.find_mixed_type_columns(self.table)
+            raise
+        # Release files store categoricals as plain strings (e.g., as character vectors in R, rather than factors)
+        for i, field in enumerate(arrow_table.schema):
+            if pyarrow.types.is_dictionary(field.type):
+                arrow_table = arrow_table.set_column(i, field.name, arrow_table.column(i).cast(field.type.value_type))
+        self.write_rda(arrow_table)
         write_frequencies(self.table, str(self.frequencies_path))
         Documentation().write(self.dataverse)
 
-        # Zip the output files
-        with ZipFile(self.csv_path.with_suffix('.zip'), 'w', ZIP_DEFLATED) as zip:
-            zip.write(self.csv_path, self.csv_path.name)
+        # Zip the output files. The CSV is only released zipped, so it's written straight into the archive rather than
+        # to disk and read back.
+        with ZipFile(self.zip_path, 'w', ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zip:
+            with zip.open(self.csv_path.name, 'w', force_zip64=True) as f:
+                write_csv(self.table, f)
             zip.write(self.frequencies_path, self.frequencies_path.name)
-            [zip.write(doc_path, doc_path.name) for doc_path in self.csv_path.parent.glob('*.md')]
+            for doc_path in self.csv_path.parent.glob('*.md'):
+                zip.write(doc_path, doc_path.name)
 
         # Validate docs
         self.check_documentation(self.table)
 
-    def write_feather(self, subset: pd.DataFrame) -> None:
-        try:
-            # Write feather
-            subset.reset_index(inplace=True, drop=True)
-            feather.write_dataframe(subset, self.feather_path)
-            # Write rda from feather
-            file_to_rda(self.feather_path, self.rda_path, self.metadata.dataset_meta['r_alias'], 'feather_to_rda.R')
-            logging.info('Wrote data to {}'.format(self.feather_path.parent))
-        except pyarrow.lib.ArrowInvalid:
-            logging.error('Error writing {} subset as feather:'.format(self.dataverse))
-            # We see this error when attempting to write 'object' dtypes that can't be mapped to feather types
-            self.find_mixed_type_columns(subset)
+    def write_rda(self, table: pyarrow.Table) -> None:
+        """Start writing the dataset to an rda (see the `rda_process` attribute)."""
+        # Stream the Arrow table straight to R, rather than writing a feather file for R to read back.
+        # R startup is slow, so conversions for datasets overlap.
+        self.rda_process = table_to_rda_async(table, self.rda_path, self.metadata.dataset_meta['r_alias'],
+                                              'feather_to_rda.R')
+        logging.info('Sent data to R for {}'.format(self.rda_path))
 
     def find_mixed_type_columns(self, subset):
-        """Find columns that can't be written as feather.
+        """Find columns that can't be converted to Arrow (and so sent to R).
         """
-        mixed_cols = []
-        for col in subset.columns:
-            try:
-                feather.write_dataframe(subset[[col]], '/dev/null')
-            except pyarrow.lib.ArrowInvalid:
-                mixed_cols.append(col)
+        # Only object columns can hold values of incompatible types (e.g., strings and ints), and infer_dtype finds
+        # them without converting any data. Ints mixed with floats ('mixed-integer-float') convert fine.
+        mixed_cols = [col for col in subset.select_dtypes(include='object').columns
+                      if pd.api.types.infer_dtype(subset[col], skipna=True) in ('mixed', 'mixed-integer')]
+        if not mixed_cols:
+            # Fall back to converting each column, for failures the inferred types don't explain
+            for col in subset.columns:
+                try:
+                    pyarrow.Table.from_pandas(subset[[col]], preserve_index=False)
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                    mixed_cols.append(col)
         if mixed_cols:
             logging.error('pyarrow error from mixed-type column: {}'.format('; '.join(mixed_cols)))
             return mixed_cols
@@ -180,23 +260,46 @@ class Dataset(object):
     def check_documentation(self, subset: pd.DataFrame) -> None:
         """Assert that all variables in data are documented, and no others.
         """
-        subset_cols = set(subset.columns.values)
-        doc_cols = {col['name'] for col in self.metadata.variable_meta}
-        not_in_docs = subset_cols - doc_cols
-        not_in_data = doc_cols - subset_cols
+        subset_cols = frozenset(subset.columns)
+        not_in_docs = subset_cols - self.metadata.documented_cols
+        not_in_data = self.metadata.documented_cols - subset_cols
         msg = ''
         if not_in_docs:
             msg += 'Undocumented variables in {}: {}. '.format(self.metadata.dataverse, not_in_docs)
         if not_in_data:
-            msg += 'Documented variables missing from {}: {}.'.format(self.metadata.dataverse, not_in_docs)
+            msg += 'Documented variables missing from {}: {}.'.format(self.metadata.dataverse, not_in_data)
         if msg:
             raise ValueError(msg)
 
 
+def write_csv(df: pd.DataFrame, f: BinaryIO) -> None:
+    """Write a dataset as CSV to a binary file, in the same format as earlier releases.
+
+    Earlier releases read nullable integer columns (e.g., county_fips) as floats, so they're written as floats,
+    e.g. '1001.0'. Rows are converted and written in chunks, so the whole frame isn't copied at once.
+    """
+    float_cols = {col: np.float64 for col, dtype in df.dtypes.items()
+                  if pd.api.types.is_extension_array_dtype(dtype) and pd.api.types.is_integer_dtype(dtype)}
+    text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    # With no rows, the range still yields a start of 0, for writing the header
+    for start in range(0, max(len(df), 1), CSV_CHUNK_ROWS):
+        chunk = df.iloc[start:start + CSV_CHUNK_ROWS].astype(float_cols)
+        chunk.to_csv(text, index=False, header=start == 0)
+    text.flush()
+    # Leave the underlying file open for the caller
+    text.detach()
+
 if __name__ == '__main__':
     precinct_data = PrecinctData()
     precinct_data.copy_state_csvs()
     Documentation().write_readme()
+    rda_processes = []
     for dataverse in DATAVERSE_SHORT_NAMES:
         dataset = Dataset(precinct_data, dataverse)
         dataset.release()
+        rda_processes.append(dataset.rda_process)
+    # Wait for the rda conversions to finish
+    for process in rda_processes:
+        if process.wait():
+            logging.error('Error writing rda: {} exited with status {}'.format(' '.join(process.args),
+                                                                               process.returncode))
@@ -4,41 +4,98 @@
 Pre-release checks against precinct returns datasets. WIP.
 """
 
+import bisect
+import functools
+import io
+import itertools
 import logging
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import plac
-import yaml
 
-from medsl import PRECINCT_COLS
+from medsl import PRECINCT_COLS, apply_substitutions
 from medsl.docs import write_frequencies
-from medsl.metadata import Metadata
+from medsl.metadata import Metadata, read_yaml
 from medsl.paths import module_path, state_csv_path
 
+# Columns with few distinct values, read as categoricals. (`writein` stays boolean, for masking.)
+CATEGORICAL_COLS = ['state', 'state_postal', 'party', 'office', 'dataverse', 'mode', 'district', 'stage']
+
+# Substitutions that normalize candidate names in constituency returns to match precinct returns, applied in order
+DISTRICT_CANDIDATE_SUBSTITUTIONS = [
+    (re.compile(r'([^,]+), ([^,]+)'), r'\2 \1'),
+    (re.compile(r' [A-Z]\. '), ' '),
+    (re.compile(r'Estella '), ''),
+    (re.compile(r'Roque ""Rocky""'), 'Rocky'),
+]
+
+# Substrings of values that often indicate a problem, like rows for totals or for ballots cast
+SUSPECT_PATTERNS = ['total', 'registered', 'cast', 'votes', 'ballot', 'write']
+# Patterns are searched separately, so a value where two patterns overlap (e.g., 'ballototal') is listed under both
+suspect_patterns = {pattern: re.compile(pattern, re.IGNORECASE) for pattern in SUSPECT_PATTERNS}
+
+
+def find_suspect_values(values):
+    """Find the values that contain each of SUSPECT_PATTERNS, returning lists of them keyed by pattern."""
+    texts = [str(value) for value in values]
+    # Search all the values at once, in a single string. They're separated by a character that no pattern matches,
+    # so each match falls within one value, found from the offsets where values start.
+    starts = list(itertools.accumulate([0] + [len(text) + 1 for text in texts[:-1]]))
+    text = '\0'.join(texts)
+    matches = {}
+    for pattern, regex in suspect_patterns.items():
+        matches[pattern] = []
+        match = regex.search(text)
+        while match:
+            i = bisect.bisect_right(starts, match.start()) - 1
+            matches[pattern].append(values[i])
+            # List each value once per pattern, by resuming the search at the next value
+            if i + 1 == len(starts):
+                break
+            match = regex.search(text, starts[i + 1])
+    return matches
+
 
 class Expectations(object):
     """Check precinct data against expectations."""
 
     def __init__(self, year=2016):
-        self.races = yaml.load((module_path / 'metadata' / '{}.yaml'.format(year)).read_text())
-        self.district_numbers = yaml.load((module_path / 'metadata' / 'districts.yaml').read_text())
+        # Reference data is read once per run and shared between instances, so it shouldn't be mutated
+        self.races = read_metadata_yaml('{}.yaml'.format(year))
+        self.district_numbers = read_metadata_yaml('districts.yaml')
         # Doesn't matter which dataverse we specify here; variable metadata is the same across dataverses
         self.meta = Metadata('house')
-        self.state_ids = pd.read_csv(module_path / 'gazetteers' / 'states.csv')
+        self.state_ids = read_states()
         self.county_ids = read_gazetteer('counties')
-
-    def check(self, df, state_postal=''):
+        # Sets of valid ids, built once rather than on every check
+        self.state_id_sets = id_sets(self.state_ids, ['state', 'state_postal', 'state_fips', 'state_icpsr'])
+        county_ids = self.county_ids.assign(county_fips=self.county_ids.county_fips.astype(np.float64))
+        self.county_id_sets = id_sets(county_ids, ['county_fips', 'county_name'])
+        # Where check() writes its output
+        self.output = sys.stdout
+
+    def check(self, df, state_postal='', output=None):
+        """Run all checks, writing output to a text stream (by default, stdout)."""
+        self.output = sys.stdout if output is None else output
         self.columns(df)
         self.values(df)
         self.states(df, state_postal)
         self.counties(df, state_postal)
-        self.districts(df, state_postal)
-        self.offices(df, state_postal)
+        # Several checks look at districts for particular offices, so split them by office once. Grouping only the
+        # columns needed keeps the groups from copying the whole frame.
+        by_office = dict(list(df[['office', 'district']].groupby('office', sort=False, observed=True)))
+        self.districts(by_office, state_postal)
+        # Several checks only need the distinct values in a column, so find them once
+        observed = {col: set(df[col].unique()) for col in ['writein', 'party']}
+        self.offices(set(by_office), state_postal)
         self.candidates(df)
-        self.writein(df)
-        self.parties(df)
+        self.writein(observed['writein'])
+        self.parties(observed['party'])
         self.votes(df)
 
     def columns(self, df):
@@ -52,101 +109,109 @@ class Expectations(object):
 
     def values(self, df):
         """Check for values that often indicate a problem."""
+        # Rows whose `mode` isn't absentee, the same for every column checked
+        not_absentee = ~df['mode'].str.contains('absentee', case=False, na=False)
         for col in ['office', 'precinct', 'district', 'candidate']:
             if col in df.columns:
-                for pattern in ['total', 'registered', 'cast', 'votes', 'ballot', 'write']:
-                    matches = df[col][df[col].str.contains(pattern, case=False).fillna(False)].unique()
-                    if matches.any():
-                        self.print_('Check {} values'.format(col), matches)
-                matches = df[~df['mode'].str.contains('absentee', case=False)]['mode'].str.contains('absentee').unique()
-                if matches.any():
-                    self.print_('Unexpected {} values where `mode` != `absentee`'.format(col), matches)
+                matches = find_suspect_values(df[col].dropna().unique())
+                for pattern in SUSPECT_PATTERNS:
+                    self.print_('Check {} values'.format(col), matches[pattern])
+                # Values that mention absentee voting should appear only in absentee rows
+                matches = [value for value in df.loc[not_absentee, col].dropna().unique()
+                           if 'absentee' in str(value).lower()]
+                self.print_('Unexpected {} values where `mode` != `absentee`'.format(col), matches)
 
     def states(self, df, valid=''):
         """Returns should have only expected state id values."""
-        state_ids = self.state_ids
-        if valid:
-            state_ids = state_ids[state_ids.state_postal == valid]
+        state_id_sets = self.state_id_sets.get(valid, {})
         try:
             for col in ['state', 'state_postal', 'state_fips', 'state_icpsr']:
-                if not np.in1d(df[col], state_ids[col]).all():
-                    self.print_('Unexpected {}'.format(col), set(df[col]) - set(state_ids[col]))
+                # Compare distinct values, rather than testing membership row by row
+                unexpected = set(df[col].unique()) - state_id_sets.get(col, frozenset())
+                self.print_('Unexpected {}'.format(col), unexpected)
         except KeyError as e:
-            print(e)
+            print(e, file=self.output)
 
     def counties(self, df, state_postal=''):
         """Returns should have only expected county id values."""
-        county_ids = self.county_ids
-        if state_postal:
-            county_ids = county_ids[county_ids.state_postal == state_postal]
+        county_id_sets = self.county_id_sets.get(state_postal, {})
         try:
-            unexpected_county_fips = set(df.query('~county_fips.isnull()').county_fips.values.astype(np.float_)) - \
-                                     set(county_ids.county_fips.astype(np.float_))
+            # Compare the distinct non-missing values in the data
+            fips_values = df.loc[df['county_fips'].notna(), 'county_fips'].unique()
+            name_values = set(df.loc[df['county_name'].notna(), 'county_name'].unique())
+            unexpected_county_fips = set(np.asarray(fips_values, dtype=np.float64)) - \
+                county_id_sets.get('county_fips', frozenset())
             self.print_('Unexpected county_fips', unexpected_county_fips)
-            unexpected_county_names = set(df.query('~county_name.isnull()').county_name.values) - \
-                                      set(county_ids.county_name.values)
-            self.print_('Unexpected county_name', unexpected_county_names)
-            missing_counties = set(county_ids.county_name.values) - set(
-                df.query('~county_name.isnull()').county_name.values)
-            self.print_('Missing counties', missing_counties)
-        except (KeyError, pd.core.computation.ops.UndefinedVariableError) as e:
+            county_names = county_id_sets.get('county_name', frozenset())
+            self.print_('Unexpected county_name', name_values - county_names)
+            self.print_('Missing counties', county_names - name_values)
+        except KeyError as e:
             logging.error(e)
 
-    def districts(self, df, state_postal):
-        """Expect district numbers in a known range as defined in `districts.yaml`, or `statewide`."""
-        if state_postal in self.races['US Senate']:
-            unexpected_senate = df.query('office == "US Senate" & district != "statewide"')['district'].unique()
-            self.print_('Unexpected district for US Senate', unexpected_senate)
-        unexpected_president = df.query('office == "US President" & district != "statewide"')['district'].unique()
-        self.print_('Unexpected district for US President', unexpected_president)
+    def districts(self, by_office, state_postal):
+        """Expect district numbers in a known range as defined in `districts.yaml`, or `statewide`.
+
+        :param by_office: The `district` column of returns for each observed office, in frames keyed by `office` value.
+        """
+        statewide_offices = ['US Senate', 'US President'] if state_postal in self.races['US Senate'] else \
+            ['US President']
+        for office in statewide_offices:
+            if office in by_office:
+                districts = by_office[office].district
+                self.print_('Unexpected district for {}'.format(office), districts[districts != 'statewide'].unique())
         for office in self.district_numbers:
-            if office not in df.office.values:
+            if office not in by_office:
                 # Don't check district validity for unobserved offices
                 continue
             n_seats = self.district_numbers[office][state_postal]
-            observed = df.loc[df.office == office].drop_duplicates()
+            # Deduplicate only the district column, rather than whole rows
+            observed = by_office[office].district.drop_duplicates()
             if n_seats == 1:
-                valid_districts = ['0']
+                valid_districts = frozenset(['0'])
             else:
-                valid_districts = [str(x) for x in range(1, n_seats + 1)]
-            unexpected_districts = observed.loc[~observed.district.isin(valid_districts), ['district']]
-            unexpected_districts.drop_duplicates(inplace=True)
-            self.print_('Unexpected {} district'.format(office), unexpected_districts.district.astype(str))
-
-    def offices(self, df, state_postal):
-        """Expect returns for known races."""
-        if 'US President' not in df.office.values:
+                valid_districts = frozenset(str(x) for x in range(1, n_seats + 1))
+            unexpected_districts = observed[~observed.isin(valid_districts)]
+            self.print_('Unexpected {} district'.format(office), unexpected_districts.astype(str))
+
+    def offices(self, observed, state_postal):
+        """Expect returns for known races, given the set of observed `office` values."""
+        if 'US President' not in observed:
             self.print_('Missing office', ['US President'])
         missing_offices = [office for office in self.races if state_postal in self.races[office] and
-                           office not in df.office.values]
+                           office not in observed]
         self.print_('Missing offices', missing_offices)
 
     def candidates(self, df):
         """`candidate` should only be missing if `writein` is True."""
         if df.candidate[~df.writein].isnull().any():
-            print('Null candidates outside of write-ins')
+            print('Null candidates outside of write-ins', file=self.output)
 
-    def writein(self, df):
-        """`writein` should only be True or False"""
-        if not df.writein.isin([True, False]).all():
-            self.print_('writein', np.unique(df.writein.values))
+    def writein(self, observed):
+        """`writein` should only be True or False, given the set of observed values."""
+        if observed - {True, False}:
+            self.print_('writein', observed)
 
-    def parties(self, df):
-        """Expect major parties and `democratic` rather than `democrat`."""
-        missing_parties = [party for party in ['republican', 'democratic'] if party not in df.party.values]
+    def parties(self, observed):
+        """Expect major parties and `democratic` rather than `democrat`, given the set of observed `party` values."""
+        missing_parties = [party for party in ['republican', 'democratic'] if party not in observed]
         self.print_('Missing party', missing_parties)
-        if 'democrat' in df.party.values:
+        if 'democrat' in observed:
             self.print_('Unexpected party', ['democrat'])
 
     def votes(self, df):
         """Votes should be ints and non-missing."""
-        unexpected_votes = df.votes[df.votes.astype(np.float_) % 1 != 0]
+        if pd.api.types.is_integer_dtype(df.votes):
+            # The usual case, since main() reads votes as ints
+            return
+        values = df.votes.to_numpy(dtype=np.float64)
+        # Missing values fail the comparison, so they're reported too
+        unexpected_votes = df.votes[~(np.mod(values, 1) == 0)]
         self.print_('Unexpected votes', unexpected_votes)
 
     def dataverse(self, df):
         """Expect valid `dataverse` values."""
         expected_dataverses = {'president', 'senate', 'house', 'state', 'local', 'all'}
-        unexpected_dataverses = df.dataverse[~df.dataverse.isin(expected_dataverses)]
+        unexpected_dataverses = set(df.dataverse.unique()) - expected_dataverses
         self.print_('Unexpected dataverse', unexpected_dataverses)
 
     def print_(self, description, values):
@@ -154,37 +219,35 @@ class Expectations(object):
         if isinstance(values, np.ndarray) or isinstance(values, pd.Series):
             if values.size:
                 lines = '\n  '.join([str(x) for x in sorted(list(values))])
-                print('\n{}:\n  {}'.format(description, lines))
+                print('\n{}:\n  {}'.format(description, lines), file=self.output)
         elif values:
             lines = '\n  '.join(sorted([str(x) for x in list(values)]))
-            print('\n{}:\n  {}'.format(description, lines))
+            print('\n{}:\n  {}'.format(description, lines), file=self.output)
 
 
 class Summary(object):
     """Summarize precinct data for manual review."""
 
     def __init__(self, df):
-        self.df = df.copy()
+        # Summaries only read from the data, so it isn't copied
+        self.df = df
         self.values = self.unique_values()
         self.freqs = write_frequencies(self.df)
         self.totals = self.constituency_totals()
 
     def __repr__(self):
-        values = 'Values:'
-        for k, v in self.values.items():
-            values += '\n  `{}`: {}'.format(k, '; '.join(v))
-        frequencies = ''
+        # Collect parts in lists and join them once, rather than growing strings
+        values = ['Values:'] + ['  `{}`: {}'.format(k, '; '.join(v)) for k, v in self.values.items()]
+        frequencies = []
         for v in ['mode', 'special', 'writein', 'office', 'dataverse']:
-            frequencies += '\n\n`{}` frequencies:\n'.format(v)
-            frequencies += self.freqs.loc[self.freqs.variable == v, ['value', 'count']]. \
-                to_string(formatters={'count': '{:,.0f}'.format})
-        totals = ''
+            frequencies.append('\n\n`{}` frequencies:\n'.format(v))
+            frequencies.append(self.freqs.loc[self.freqs.variable == v, ['value', 'count']].
+                               to_string(formatters={'count': '{:,.0f}'.format}))
+        totals = []
         for k, v in self.totals.items():
-            if 'state' in v.columns:
-                del v['state']
-            totals += '\n\nMEDSL aggregates for {}:\n'.format(k.title())
-            totals += v.to_string(float_format='{:,.0f}'.format)
-        return '\n'.join([values, frequencies, totals])
+            totals.append('\n\nMEDSL aggregates for {}:\n'.format(k.title()))
+            totals.append(v.drop(columns='state', errors='ignore').to_string(float_format='{:,.0f}'.format))
+        return '\n'.join(['\n'.join(values), ''.join(frequencies), ''.join(totals)])
 
     def unique_values(self):
         columns = sorted(
@@ -193,8 +256,13 @@ class Summary(object):
         return values
 
     def constituency_totals(self):
+        # Group only the columns that _compare_aggregates uses, rather than copying the whole frame by office
+        precincts = self.df[['office', 'state', 'candidate', 'party', 'votes']]
+        by_office = dict(list(precincts.groupby('office', sort=False, observed=True)))
+        # Offices without returns are compared as empty
+        no_returns = precincts.iloc[:0]
         totals = {
-            office: self._compare_aggregates(self.df.query('office == "US {}"'.format(office.title())), office)
+            office: self._compare_aggregates(by_office.get('US {}'.format(office.title()), no_returns), office)
             for office in ['president', 'senate', 'house']
         }
         return totals
@@ -211,40 +279,63 @@ class Summary(object):
         # FIXME: release-ready constituency returns still live in ./output but should be moved into a sibling directory,
         # just as the precinct returns were, like:
         # districts = pd.read_csv(Path(dataset_output_path(Path(district_dataset)) / '{}.csv'.format(district_dataset)))
-        districts = pd.read_csv(Path(module_path, 'output', district_dataset, '1976-2016-{}.csv'.format(dataverse)))
+        districts = pd.read_csv(Path(module_path, 'output', district_dataset, '1976-2016-{}.csv'.format(dataverse)),
+                                usecols=['year', 'state', 'candidate', 'party', 'candidatevotes'])
 
         # Keep district data where we have precinct data for comparison
-        districts = districts.loc[districts.year == 2016]
-        districts = districts.loc[districts.state.isin(set(precincts.state))]
-        # Normalize candidate names in district data
-        districts = districts.assign(candidate=districts.candidate.str.replace('([^,]+), ([^,]+)', '\\2 \\1'))
-        districts = districts.assign(candidate=districts.candidate.str.replace(' [A-Z]\\. ', ' '))
-        districts = districts.assign(candidate=districts.candidate.str.replace('Estella ', ''))
-        districts = districts.assign(candidate=districts.candidate.str.replace('Roque \"\"Rocky\"\"', 'Rocky'))
+        # A single mask selects (and copies) the rows once
+        states = set(precincts.state.unique())
+        districts = districts.loc[(districts.year.values == 2016) & districts.state.isin(states).values]
+        # Normalize candidate names in district data, substituting in each distinct name once
+        normalized = {name: apply_substitutions(name, DISTRICT_CANDIDATE_SUBSTITUTIONS)
+                      for name in districts.candidate.dropna().unique()}
+        districts = districts.assign(candidate=districts.candidate.map(normalized))
 
         # Tidy up
         keep = ['state', 'candidate', 'party']
-        districts.rename({'candidatevotes': 'district_votes'}, axis=1, inplace=True)
-        precincts = precincts.copy()
-        precincts.rename({'votes': 'precinct_votes'}, axis=1, inplace=True)
-        precincts = precincts[keep + ['precinct_votes']]
-        districts = districts[keep + ['district_votes']]
+        # Select columns before renaming, so that only the selection is copied
+        precincts = precincts[keep + ['votes']].rename(columns={'votes': 'precinct_votes'})
+        districts = districts[keep + ['candidatevotes']].rename(columns={'candidatevotes': 'district_votes'})
 
         # Aggregate (e.g. over candidates) to district totals
         by = ['state', 'candidate']
-        precinct_totals = precincts.groupby(by, as_index=False).agg({'precinct_votes': sum})
-        district_totals = districts.groupby(by, as_index=False).agg({'district_votes': sum})
-        totals = pd.merge(precinct_totals, district_totals, how='outer')
+        precinct_totals = precincts.groupby(by, observed=True)['precinct_votes'].sum()
+        district_totals = districts.groupby(by)['district_votes'].sum()
+        # Both totals are indexed by state and candidate, so align them on the index rather than merging
+        # Sort the union of keys by state and candidate, as an outer merge would
+        totals = pd.concat([precinct_totals, district_totals], axis=1).sort_index().reset_index()
 
         # Add final total row and difference column
-        total_row = totals.sum(numeric_only=True)
-        total_row['candidate'] = 'Total'
-        totals = totals.append(total_row, ignore_index=True)
-        totals = totals.assign(votes_diff=totals.precinct_votes - totals.district_votes)
+        totals.loc[len(totals)] = pd.Series({
+            'candidate': 'Total',
+            'precinct_votes': precinct_totals.sum(),
+            'district_votes': district_totals.sum(),
+        })
+        totals['votes_diff'] = totals.precinct_votes - totals.district_votes
 
         return totals
 
 
+def id_sets(ids, columns):
+    """Get the values in columns of an id table as sets, for all states (key '') and for each state postal code."""
+    sets = {'': {col: frozenset(ids[col]) for col in columns}}
+    for state_postal, group in ids.groupby('state_postal', observed=True):
+        sets[state_postal] = {col: frozenset(group[col]) for col in columns}
+    return sets
+
+
+def read_metadata_yaml(filename):
+    """Read a YAML file from the metadata directory, parsing it only once per run."""
+    return read_yaml(str(module_path / 'metadata' / filename))
+
+
+@functools.lru_cache(maxsize=None)
+def read_states():
+    """Read state ids, once per run."""
+    return pd.read_csv(module_path / 'gazetteers' / 'states.csv')
+
+
+@functools.lru_cache(maxsize=None)
 def read_gazetteer(unit='counties'):
     if unit == 'counties':
         file = '2017_Gaz_{}_national.txt'.format(unit)
@@ -257,29 +348,57 @@ def read_gazetteer(unit='counties'):
         col_prefix = unit
     else:
         raise ValueError
-    df = pd.read_csv(module_path / 'gazetteers' / file, encoding='latin1', delimiter='\t', dtype=dict(GEOID=str))
     names = {
         'USPS': 'state_postal',
         'GEOID': '{}_fips'.format(col_prefix),
         'NAME': '{}_name'.format(col_prefix)
     }
+    df = pd.read_csv(module_path / 'gazetteers' / file, encoding='latin1', delimiter='\t', usecols=list(names),
+                     dtype=dict(GEOID=str, USPS='category', NAME=str))
     df.rename(names, axis=1, inplace=True)
     df = df[list(names.values())]
     return df
 
 
+def read_state(state_postal):
+    """Read a state's precinct returns for validation."""
+    dtypes = dict(PRECINCT_COLS, **{col: 'category' for col in CATEGORICAL_COLS})
+    return pd.read_csv(state_csv_path(state_postal), dtype=dtypes)
+
+
+def validate(state_postal):
+    """Check a state's precinct returns and summarize them, returning the output."""
+    df = read_state(state_postal)
+    # Buffer the output, which is written once when validation is done
+    output = io.StringIO()
+    expectations = Expectations()
+    expectations.check(df, state_postal, output)
+    output.write('{}\n'.format(Summary(df)))
+    return output.getvalue()
+
+
+def main_all(state_postals):
+    """Validate several states at once, returning their output in the order given."""
+    # Read reference data before starting workers, which inherit it (where processes fork) through the caches
+    Expectations()
+    with ProcessPoolExecutor() as executor:
+        return list(executor.map(validate, state_postals))
+
+
 @plac.annotations(
-    state_postal=('State postal abbreviation', 'positional', None, str),
+    state_postals=('State postal abbreviations', 'positional', None, str),
 )
-def main(state_postal):
+def main(*state_postals):
     """Produce validation output.
 
-    The state precinct Makefile calls this function with output piped to `checks.txt` in a state data directory.
+    The state precinct Makefile calls this function for one state with output piped to `checks.txt` in a state data
+    directory. Given several states, it validates them in parallel and prints each state's output under a heading.
     """
-    df = pd.read_csv(state_csv_path(state_postal), dtype=PRECINCT_COLS)
-    expectations = Expectations()
-    expectations.check(df, state_postal)
-    print(Summary(df))
+    if len(state_postals) == 1:
+        sys.stdout.write(validate(state_postals[0]))
+        return
+    for state_postal, output in zip(state_postals, main_all(state_postals)):
+        sys.stdout.write('# {}\n\n{}\n'.format(state_postal, output))
 
 
 if __name__ == '__main__':